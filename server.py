@@ -1,116 +1,555 @@
 import asyncio
+import base64
+import hashlib
+import itertools
+import logging
+import logging.handlers
+import multiprocessing
+import queue
 import websockets
-import random
-import json
 import os
-from aiohttp import web
+import secrets
+import socket
+import zlib
+import msgpack
+import orjson
+from aiohttp import ClientError, ClientSession, web
+
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
+
+log = logging.getLogger(__name__)
+
+# --- Sharding ---
+# With WORKERS > 1 each worker process owns the rooms whose codes hash to its
+# index, and a front process routes every WebSocket to the owning worker.
+# That router still relays every frame through one Python process, so it
+# spreads room state across cores but not proxy throughput, which stays
+# capped near what a single process handles. Past that, run each worker on
+# its own (WORKER_INDEX set) behind nginx, as in nginx.conf.example.
+WORKERS = int(os.environ.get('WORKERS', 1))
+WORKER_INDEX = 0
+# Seconds between the front process's checks that every worker is still alive
+WORKER_CHECK_INTERVAL = 1
+
+def shard_for(room_code):
+    """
+    Returns the index of the worker that owns a room code.
+    This is the server nginx's (non-consistent) "hash" directive picks from
+    an upstream of equally weighted workers, so either router agrees.
+    """
+    return ((zlib.crc32(room_code.encode()) >> 16) & 0x7fff) % WORKERS
+
+def normalize_code(code):
+    """
+    Returns the canonical, uppercase form of a client-supplied channel ID.
+    Generated IDs are uppercase hex, so lookups and sharding ignore case.
+    Anything that is not a non-empty string becomes None.
+    """
+    if not isinstance(code, str):
+        return None
+    return code.strip().upper() or None
 
 # --- Data Structure ---
-# This remains the same.
-# {'12345': {ws_user1: 'User 1', ws_user2: 'User 2'}}
+# {'12345': Room(members={ws_user1: 'User 1', ws_user2: 'User 2'})}
 ROOMS = {}
 
+class Room:
+    """A chat channel and the sockets of its members."""
+
+    __slots__ = ("members", "ws_list", "codec_map")
+
+    def __init__(self):
+        # {ws_user1: 'User 1'}, for looking up a sender's name
+        self.members = {}
+        # The same sockets in join order, for walking on every broadcast
+        self.ws_list = []
+        # {ws_user1: 'json', ws_user2: 'msgpack'}
+        self.codec_map = {}
+
+    def add(self, ws, user_name, codec):
+        self.members[ws] = user_name
+        self.ws_list.append(ws)
+        self.codec_map[ws] = codec
+
+    def remove(self, ws):
+        self.ws_list.remove(ws)
+        del self.codec_map[ws]
+        return self.members.pop(ws)
+
+# --- Wire Protocol ---
+# Clients send one request object per frame, {"action": ..., ...}, as JSON in a
+# text frame or msgpack in a binary frame. A text frame "m|<text>" is a chat
+# message too, the same as {"action": "message", "text": "<text>"}.
+#
+# Each frame from the server holds one message object, or an array of message
+# objects to be handled in order:
+#   json clients: a text frame is JSON. A binary frame is zlib-deflated JSON
+#                 (RFC 1950, e.g. DecompressionStream('deflate') in browsers)
+#                 holding one message over COMPRESS_THRESHOLD bytes.
+#   msgpack clients: binary frames only, each a msgpack map or array.
+# permessage-deflate is not offered; compression is only the deflate above.
+
+# Wire formats a client can negotiate with "codec" in its create/join request.
+# JSON travels in text frames, msgpack in binary frames.
+CODECS = ("json", "msgpack")
+# Encoded frames are (kind, bytes) pairs; "deflate" is zlib-compressed JSON.
+# Every kind is written as-is with send_frame, so JSON encoded by orjson is
+# never decoded to str just for aiohttp to encode it back to UTF-8.
+FRAME_OPCODES = {"json": web.WSMsgType.TEXT, "msgpack": web.WSMsgType.BINARY, "deflate": web.WSMsgType.BINARY}
+# JSON broadcasts longer than this are zlib-compressed once and sent to JSON
+# clients as binary frames, instead of each socket deflating its own copy
+COMPRESS_THRESHOLD = 256
+
+# Frames waiting to be written, per connection: {ws: (asyncio.Queue, transport)}
+# Each queue is drained by that connection's single writer task.
+OUTBOXES = {}
+# Frames buffered for a client; one whose outbox fills has stopped reading
+# and is disconnected, since dropping frames would lose chat messages
+OUTBOX_SIZE = 256
+# Past this many queued frames, readers yield so the writers can catch up
+OUTBOX_BACKLOG = OUTBOX_SIZE // 2
+# Sockets whose outbox went past OUTBOX_BACKLOG since readers last yielded
+BACKED_UP = set()
+# Transport write buffer watermarks for WebSocket connections: sends pause
+# above the high mark, so a slow client backs up into its outbox instead
+WRITE_BUFFER_HIGH = 64 * 1024
+WRITE_BUFFER_LOW = 16 * 1024
+
 # --- WebSocket Logic (largely unchanged) ---
 
-async def notify_users_in_room(room_code, message):
-    if room_code in ROOMS:
-        tasks = [user.send_str(json.dumps(message)) for user in ROOMS[room_code]]
-        if tasks:
-            await asyncio.gather(*tasks)
+def _json_default(value):
+    # msgpack clients may send file data as raw bytes; JSON clients expect base64
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode()
+    raise TypeError
+
+def encode(message, codec):
+    """Serializes a message for a client into a frame of the given codec."""
+    if codec == "msgpack":
+        return ("msgpack", msgpack.packb(message))
+    return ("json", orjson.dumps(message, default=_json_default))
+
+# Replies whose content never changes, encoded once for each codec at import
+ERR_ROOM_NOT_FOUND = {codec: encode({"type": "error", "message": "Room not found."}, codec) for codec in CODECS}
+ERR_UNKNOWN_ACTION = {codec: encode({"type": "error", "message": "Unknown action."}, codec) for codec in CODECS}
+ERR_MALFORMED_MESSAGE = {codec: encode({"type": "error", "message": "Malformed message."}, codec) for codec in CODECS}
+ERR_NOT_IN_ROOM = {codec: encode({"type": "error", "message": "Not in a room."}, codec) for codec in CODECS}
+
+def encode_broadcast(message, codec, message_prefix=None):
+    """
+    Like encode, but compresses large JSON payloads that many sockets will share.
+    A new_message with string text can pass its sender's message_prefix, so
+    only the text needs encoding for JSON recipients.
+    """
+    if codec == "json" and message_prefix is not None:
+        frame = ("json", message_prefix + orjson.dumps(message["text"]) + b"}")
+    else:
+        frame = encode(message, codec)
+    kind, payload = frame
+    if kind == "json" and len(payload) > COMPRESS_THRESHOLD:
+        return ("deflate", zlib.compress(payload, 1))
+    return frame
+
+def _reject_ext(code, data):
+    # No message carries msgpack extension types, and JSON clients could not receive them
+    raise ValueError(f"msgpack extension type {code}")
+
+def decode(msg):
+    """
+    Parses a text (JSON) or binary (msgpack) frame into a dict.
+    Returns None when the frame is not a well-formed object.
+    """
+    try:
+        if msg.type == web.WSMsgType.BINARY:
+            data = msgpack.unpackb(msg.data, raw=False, ext_hook=_reject_ext)
+        else:
+            # Tolerate a leading byte order mark, which neither JSON parser accepts
+            data = orjson.loads(msg.data.removeprefix("\ufeff"))
+    except (orjson.JSONDecodeError, ValueError, msgpack.UnpackException):
+        return None
+    return data if isinstance(data, dict) else None
+
+async def send(ws, frame):
+    """Sends an encoded frame with the opcode for its kind."""
+    kind, payload = frame
+    await ws.send_frame(payload, FRAME_OPCODES[kind])
+
+def enqueue(ws, frame):
+    """
+    Queues a frame for the connection's writer.
+    A connection whose outbox is already full is aborted instead.
+    """
+    entry = OUTBOXES.get(ws)
+    if entry is None:
+        return
+    outbox, transport = entry
+    if outbox.full():
+        log.warning("Disconnecting a client that stopped reading; %s queued frames were dropped.", outbox.qsize() + 1)
+        # Nothing more is queued for it; its handler cleans up once the socket closes
+        del OUTBOXES[ws]
+        if transport is not None:
+            transport.abort()
+        return
+    outbox.put_nowait(frame)
+    if outbox.qsize() > OUTBOX_BACKLOG:
+        BACKED_UP.add(ws)
+
+def _batch_key(frame):
+    # Frames over COMPRESS_THRESHOLD are never merged, whatever their codec, so a
+    # batch stays under OUTBOX_SIZE * COMPRESS_THRESHOLD bytes (64 KiB) and far
+    # below the 4 MB receive limit aiohttp clients default to
+    kind, payload = frame
+    if kind == "deflate" or len(payload) > COMPRESS_THRESHOLD:
+        return None
+    return kind
+
+def coalesce(frames):
+    """
+    Merges each run of small same-codec frames into a single frame holding an array.
+    Encoded JSON is joined as text; msgpack gets an array header in front.
+    Large and compressed frames always go out one by one.
+    """
+    for kind, run in itertools.groupby(frames, key=_batch_key):
+        run = list(run)
+        if kind is None or len(run) == 1:
+            yield from run
+        elif kind == "msgpack":
+            yield (kind, msgpack.Packer().pack_array_header(len(run)) + b"".join(payload for _, payload in run))
+        else:
+            yield (kind, b"[" + b",".join(payload for _, payload in run) + b"]")
+
+async def _writer(ws, outbox):
+    """Writes queued frames to the socket; the only coroutine that sends on it."""
+    try:
+        while True:
+            # Everything that piled up during the last send goes out together
+            batch = [await outbox.get()]
+            while not outbox.empty():
+                batch.append(outbox.get_nowait())
+            for frame in coalesce(batch):
+                await send(ws, frame)
+    except ConnectionError:
+        # Lost mid-send, e.g. aborted by enqueue while waiting for the client to
+        # drain; the connection's handler cleans up once its socket closes
+        pass
+
+async def notify_users_in_room(room_code, message, exclude=None, message_prefix=None):
+    """Broadcasts a message to a room."""
+    room = ROOMS.get(room_code)
+    if room is None:
+        return
+    # A lone member (usually the creator) needs no per-codec bookkeeping,
+    # and nothing is encoded at all when that member is the sender
+    if len(room.ws_list) == 1:
+        user = room.ws_list[0]
+        if user is not exclude:
+            enqueue(user, encode_broadcast(message, room.codec_map[user], message_prefix))
+        return
+    # Encode at most once per codec, however many users share it
+    payloads = {}
+    # Iterate the live list without copying it: enqueue never awaits or
+    # changes membership, so the room cannot change under this loop
+    for user in room.ws_list:
+        if user is not exclude:
+            codec = room.codec_map[user]
+            if codec not in payloads:
+                payloads[codec] = encode_broadcast(message, codec, message_prefix)
+            enqueue(user, payloads[codec])
 
 async def handle_disconnect(websocket, room_code):
-    if room_code in ROOMS and websocket in ROOMS[room_code]:
-        user_name = ROOMS[room_code].pop(websocket)
-        print(f"{user_name} disconnected from room {room_code}.")
-        if not ROOMS[room_code]:
+    if room_code in ROOMS and websocket in ROOMS[room_code].members:
+        user_name = ROOMS[room_code].remove(websocket)
+        log.info("%s disconnected from room %s.", user_name, room_code)
+        if not ROOMS[room_code].members:
             del ROOMS[room_code]
-            print(f"Room {room_code} is empty and has been deleted.")
+            log.info("Room %s is empty and has been deleted.", room_code)
         else:
             notification = {"type": "user_left", "userName": user_name}
             await notify_users_in_room(room_code, notification)
 
+class Session:
+    """Per-connection state threaded through the action handlers."""
+
+    __slots__ = ("ws", "room_code", "codec", "message_prefix")
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.room_code = None
+        self.codec = "json"
+        # Start of this user's new_message JSON, filled in once they are in a room
+        self.message_prefix = None
+
+# The new_message schema is fixed and a user's name never changes inside a
+# room, so everything up to the text value is formatted once per session
+NEW_MESSAGE_PREFIX = '{{"type":"new_message","sender":{},"text":'
+
+def tune_transport(transport):
+    """Sets up a chat socket for small, latency-sensitive frames."""
+    if transport is None:
+        return
+    sock = transport.get_extra_info('socket')
+    if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH, low=WRITE_BUFFER_LOW)
+
+async def broadcast_chat_message(session, text):
+    """Relays a chat message from the session's user to everyone else in its room."""
+    sender_name = ROOMS[session.room_code].members.get(session.ws)
+    broadcast_message = {"type": "new_message", "sender": sender_name, "text": text}
+    # The prefix shortcut is only valid when text encodes as a JSON string
+    message_prefix = session.message_prefix if isinstance(text, str) else None
+    await notify_users_in_room(session.room_code, broadcast_message, exclude=session.ws, message_prefix=message_prefix)
+
+async def _handle_create(session, data):
+    ws = session.ws
+    custom_code = normalize_code(data.get("code"))
+    if custom_code:
+        if custom_code in ROOMS:
+            enqueue(ws, encode({"type": "error", "message": f"Channel ID '{custom_code}' is already in use."}, session.codec))
+            return
+        # Joiners are routed by the code, so its room can only live on the worker
+        # that owns it; clients must connect with ?room=<code> to get there
+        if shard_for(custom_code) != WORKER_INDEX:
+            message = f"Channel ID '{custom_code}' belongs to another server; reconnect with ?room={custom_code}."
+            enqueue(ws, encode({"type": "error", "message": message}, session.codec))
+            return
+        room_code = custom_code
+    else:
+        # 16M possible codes, so the retry almost never runs on a single worker;
+        # with shards it also skips codes that would route to another worker
+        room_code = secrets.token_hex(3).upper()
+        while room_code in ROOMS or shard_for(room_code) != WORKER_INDEX:
+            room_code = secrets.token_hex(3).upper()
+
+    ROOMS[room_code] = Room()
+    ROOMS[room_code].add(ws, "User 1", session.codec)
+    session.room_code = room_code
+    session.message_prefix = NEW_MESSAGE_PREFIX.format(orjson.dumps("User 1").decode()).encode()
+    enqueue(ws, encode({"type": "room_created", "code": room_code, "userName": "User 1"}, session.codec))
+    log.info("Room %s created by User 1.", room_code)
+
+async def _handle_join(session, data):
+    ws = session.ws
+    code_to_join = normalize_code(data.get("code"))
+    if code_to_join not in ROOMS:
+        enqueue(ws, ERR_ROOM_NOT_FOUND[session.codec])
+        return
+    room = ROOMS[code_to_join]
+    user_number = len(room.members) + 1
+    user_name = f"User {user_number}"
+    room.add(ws, user_name, session.codec)
+    session.room_code = code_to_join
+    session.message_prefix = NEW_MESSAGE_PREFIX.format(orjson.dumps(user_name).decode()).encode()
+    enqueue(ws, encode({"type": "joined_success", "code": code_to_join, "userName": user_name}, session.codec))
+    notification = {"type": "user_joined", "userName": user_name}
+    await notify_users_in_room(code_to_join, notification)
+    log.info("%s joined room %s.", user_name, code_to_join)
+
+async def _handle_message(session, data):
+    if not session.room_code:
+        enqueue(session.ws, ERR_NOT_IN_ROOM[session.codec])
+        return
+    await broadcast_chat_message(session, data.get("text"))
+
+async def _handle_file(session, data):
+    if not session.room_code:
+        enqueue(session.ws, ERR_NOT_IN_ROOM[session.codec])
+        return
+    sender_name = ROOMS[session.room_code].members.get(session.ws)
+    broadcast_message = {
+        "type": "new_file", "sender": sender_name, "filename": data.get("filename"),
+        "filetype": data.get("filetype"), "filedata": data.get("filedata")
+    }
+    await notify_users_in_room(session.room_code, broadcast_message, exclude=session.ws)
+
+async def _handle_leave(session, data):
+    if not session.room_code:
+        enqueue(session.ws, ERR_NOT_IN_ROOM[session.codec])
+        return
+    await handle_disconnect(session.ws, session.room_code)
+    session.room_code = None
+    await session.ws.close()
+
+# {action: handler(session, data)}, most frequent action first
+HANDLERS = {
+    "message": _handle_message,
+    "join": _handle_join,
+    "create": _handle_create,
+    "leave": _handle_leave,
+    "file": _handle_file,
+}
+
 async def websocket_handler(request):
     """
     Handles the WebSocket connections.
     This is the core chat logic, adapted for aiohttp.
     """
-    ws = web.WebSocketResponse()
+    # Large broadcasts are compressed once up front, so skip permessage-deflate
+    ws = web.WebSocketResponse(compress=False)
     await ws.prepare(request)
+    tune_transport(request.transport)
+    outbox = asyncio.Queue(maxsize=OUTBOX_SIZE)
+    OUTBOXES[ws] = (outbox, request.transport)
+    writer = asyncio.create_task(_writer(ws, outbox))
 
-    current_room_code = None
+    session = Session(ws)
     try:
         async for msg in ws:
-            if msg.type == web.WSMsgType.TEXT:
-                data = json.loads(msg.data)
+            # Frames that are already buffered are read without ever yielding,
+            # so during a burst the writers only get to run here
+            if BACKED_UP:
+                BACKED_UP.clear()
+                await asyncio.sleep(0)
+
+            # Chat text, by far the most common frame, comes as "m|<text>" and
+            # skips the JSON parser; every other frame is decoded below
+            if msg.type == web.WSMsgType.TEXT and msg.data.startswith("m|"):
+                if session.room_code:
+                    await broadcast_chat_message(session, msg.data[2:])
+                else:
+                    enqueue(ws, ERR_NOT_IN_ROOM[session.codec])
+                continue
+
+            if msg.type in (web.WSMsgType.TEXT, web.WSMsgType.BINARY):
+                data = decode(msg)
+                if data is None:
+                    enqueue(ws, ERR_MALFORMED_MESSAGE[session.codec])
+                    continue
                 action = data.get("action")
+                if action in ("create", "join") and data.get("codec") in CODECS:
+                    session.codec = data["codec"]
 
-                if action == "create":
-                    custom_code = data.get("code")
-                    if custom_code:
-                        if custom_code in ROOMS:
-                            await ws.send_str(json.dumps({"type": "error", "message": f"Channel ID '{custom_code}' is already in use."}))
-                            continue
-                        else:
-                            room_code = custom_code
-                    else:
-                        room_code = str(random.randint(10000, 99999))
-                        while room_code in ROOMS:
-                            room_code = str(random.randint(10000, 99999))
-                    
-                    ROOMS[room_code] = {ws: "User 1"}
-                    current_room_code = room_code
-                    await ws.send_str(json.dumps({"type": "room_created", "code": room_code, "userName": "User 1"}))
-                    print(f"Room {room_code} created by User 1.")
-
-                elif action == "join":
-                    code_to_join = data.get("code")
-                    if code_to_join in ROOMS:
-                        room = ROOMS[code_to_join]
-                        user_number = len(room) + 1
-                        user_name = f"User {user_number}"
-                        room[ws] = user_name
-                        current_room_code = code_to_join
-                        await ws.send_str(json.dumps({"type": "joined_success", "code": code_to_join, "userName": user_name}))
-                        notification = {"type": "user_joined", "userName": user_name}
-                        await notify_users_in_room(code_to_join, notification)
-                        print(f"{user_name} joined room {code_to_join}.")
-                    else:
-                        await ws.send_str(json.dumps({"type": "error", "message": "Room not found."}))
-
-                elif action == "message" and current_room_code:
-                    sender_name = ROOMS[current_room_code].get(ws)
-                    broadcast_message = {"type": "new_message", "sender": sender_name, "text": data.get("text")}
-                    tasks = [user.send_str(json.dumps(broadcast_message)) for user in ROOMS[current_room_code] if user != ws]
-                    if tasks: await asyncio.gather(*tasks)
-
-                elif action == "file" and current_room_code:
-                    sender_name = ROOMS[current_room_code].get(ws)
-                    broadcast_message = {
-                        "type": "new_file", "sender": sender_name, "filename": data.get("filename"),
-                        "filetype": data.get("filetype"), "filedata": data.get("filedata")
-                    }
-                    tasks = [user.send_str(json.dumps(broadcast_message)) for user in ROOMS[current_room_code] if user != ws]
-                    if tasks: await asyncio.gather(*tasks)
-
-                elif action == "leave" and current_room_code:
-                    await handle_disconnect(ws, current_room_code)
-                    current_room_code = None
-                    await ws.close()
+                # Non-string actions (lists, objects) cannot be dict keys
+                handler = HANDLERS.get(action) if isinstance(action, str) else None
+                if handler is None:
+                    enqueue(ws, ERR_UNKNOWN_ACTION[session.codec])
+                    continue
+                try:
+                    await handler(session, data)
+                except orjson.JSONEncodeError:
+                    # msgpack can carry values JSON cannot, such as timestamps
+                    # or bytes map keys, which fail once relayed to JSON clients
+                    enqueue(ws, ERR_MALFORMED_MESSAGE[session.codec])
 
             elif msg.type == web.WSMsgType.ERROR:
-                print(f'ws connection closed with exception {ws.exception()}')
+                log.warning('ws connection closed with exception %s', ws.exception())
 
     finally:
-        if current_room_code:
-            await handle_disconnect(ws, current_room_code)
+        if session.room_code:
+            await handle_disconnect(ws, session.room_code)
+        writer.cancel()
+        OUTBOXES.pop(ws, None)
+        BACKED_UP.discard(ws)
     
     return ws
 
 # --- HTTP Logic (to serve the HTML file) ---
 
+# The page never changes while the server runs, so read it once. It is found
+# next to this file, whatever directory the server (or a worker) starts in.
+INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'index.html')
+with open(INDEX_PATH, 'rb') as index_file:
+    INDEX_BYTES = index_file.read()
+INDEX_ETAG = f'"{hashlib.md5(INDEX_BYTES).hexdigest()}"'
+INDEX_HEADERS = {'ETag': INDEX_ETAG, 'Cache-Control': 'public, max-age=60'}
+
 async def handle_http(request):
     """Serves the index.html file."""
-    return web.FileResponse('./index.html')
+    if_none_match = request.headers.get('If-None-Match', '')
+    if INDEX_ETAG in (tag.strip() for tag in if_none_match.split(',')):
+        return web.Response(status=304, headers=INDEX_HEADERS)
+    return web.Response(body=INDEX_BYTES, content_type='text/html', charset='utf-8', headers=INDEX_HEADERS)
+
+# --- Shard Routing (front process, only used with WORKERS > 1) ---
+
+async def _pipe(source, target):
+    """Forwards frames from one WebSocket to another until either side closes."""
+    try:
+        async for msg in source:
+            if msg.type == web.WSMsgType.TEXT:
+                await target.send_str(msg.data)
+            elif msg.type == web.WSMsgType.BINARY:
+                await target.send_bytes(msg.data)
+    except ConnectionError:
+        # The target went away mid-stream (aiohttp raises a bare ConnectionError
+        # when it is lost during a drain); closing the source ends the other pipe
+        await source.close()
+    await target.close()
+
+async def route_websocket(request):
+    """
+    Connects a client to the worker that owns the room in its ?room= query.
+    Clients creating a room with a generated code may land on any worker.
+    """
+    room_code = normalize_code(request.query.get('room'))
+    shard = shard_for(room_code) if room_code else secrets.randbelow(WORKERS)
+    # Reach the worker before accepting the client, so a worker that is still
+    # starting or being restarted fails the handshake with a 503
+    worker_url = f"http://127.0.0.1:{request.app['worker_ports'][shard]}/ws"
+    try:
+        worker_ws = await request.app['client_session'].ws_connect(worker_url, compress=0)
+    except ClientError as exc:
+        log.warning("Worker %s is unavailable: %s", shard, exc)
+        raise web.HTTPServiceUnavailable()
+    try:
+        client_ws = web.WebSocketResponse(compress=False)
+        await client_ws.prepare(request)
+        tune_transport(request.transport)
+        await asyncio.gather(_pipe(client_ws, worker_ws), _pipe(worker_ws, client_ws))
+    finally:
+        await worker_ws.close()
+    return client_ws
+
+async def _client_session(app):
+    async with ClientSession() as session:
+        app['client_session'] = session
+        yield
+
+def _start_worker(index, port):
+    # Spawned rather than forked: the front process's event loop is already running
+    worker = multiprocessing.get_context('spawn').Process(target=serve_worker, args=(index, port), daemon=True)
+    worker.start()
+    return worker
+
+async def _worker_processes(app):
+    """
+    Starts the shard workers and restarts any that exit while the router runs.
+    A restarted worker comes back empty; the rooms it owned are gone.
+    """
+    ports = app['worker_ports']
+    workers = [_start_worker(index, port) for index, port in enumerate(ports)]
+
+    async def supervise():
+        while True:
+            await asyncio.sleep(WORKER_CHECK_INTERVAL)
+            for index, worker in enumerate(workers):
+                if not worker.is_alive():
+                    log.warning("Worker %s exited with code %s; restarting it.", index, worker.exitcode)
+                    workers[index] = _start_worker(index, ports[index])
+
+    app['supervisor'] = asyncio.create_task(supervise())
+    yield
+    for worker in workers:
+        worker.terminate()
+        worker.join()
+
+async def _stop_supervisor(app):
+    # Runs as soon as shutdown begins, before open connections are waited for:
+    # workers that exit from then on (e.g. on the same Ctrl+C) stay down
+    app['supervisor'].cancel()
+
+def make_router(worker_ports):
+    router = web.Application()
+    router['worker_ports'] = worker_ports
+    router.cleanup_ctx.append(_worker_processes)
+    router.on_shutdown.append(_stop_supervisor)
+    router.cleanup_ctx.append(_client_session)
+    router.router.add_get('/', handle_http)
+    router.router.add_get('/ws', route_websocket)
+    return router
 
 # --- Application Setup ---
 
@@ -118,10 +557,39 @@ app = web.Application()
 app.router.add_get('/', handle_http)  # Serve index.html at the root URL
 app.router.add_get('/ws', websocket_handler) # Handle WebSocket connections at /ws
 
+def serve(application, host, port):
+    """Runs an application in this process until it is interrupted."""
+    # Run on libuv's event loop where available; it is much faster for socket I/O
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    # Log through a queue so the event loop never blocks writing to stdout
+    log_queue = queue.SimpleQueue()
+    logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(log_queue)])
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    try:
+        web.run_app(application, host=host, port=port)
+        log.info("Server running on http://%s:%s", host, port)
+    finally:
+        listener.stop()
+
+def serve_worker(index, port, host='127.0.0.1'):
+    """Entry point for a shard worker process."""
+    global WORKER_INDEX
+    WORKER_INDEX = index
+    serve(app, host, port)
+
 if __name__ == '__main__':
     # Get port from environment variable for Render, default to 8080 for local dev
     port = int(os.environ.get('PORT', 8080))
     # Host on 0.0.0.0 to be accessible from outside the container
-    web.run_app(app, host='0.0.0.0', port=port)
-    print(f"Server running on http://0.0.0.0:{port}")
-
+    if WORKERS == 1:
+        serve(app, '0.0.0.0', port)
+    elif 'WORKER_INDEX' in os.environ:
+        # A single shard, with an external balancer routing to it by room code
+        serve_worker(int(os.environ['WORKER_INDEX']), port, '0.0.0.0')
+    else:
+        # Workers listen on the loopback ports right above the public one;
+        # the router starts them and keeps them running
+        worker_ports = [port + 1 + index for index in range(WORKERS)]
+        serve(make_router(worker_ports), '0.0.0.0', port)